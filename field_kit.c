@@ -23,6 +23,8 @@ field_kit_command_t field_kit_parse_command(const char *command) {
         return CMD_SIDE_INFO;
     } else if (strcmp(command, "STATUS") == 0) {
         return CMD_STATUS;
+    } else if (strcmp(command, "ALL_INFO") == 0) {
+        return CMD_ALL_INFO;
     }
     return CMD_UNKNOWN;
 }
@@ -66,11 +68,13 @@ void field_kit_send_response(field_kit_response_t *response, uint8_t original_le
     
     response_data[0] = response->status;
     
-    // Copy message if it fits
+    // Copy message, leaving room for the ETX terminator that marks its end
     size_t msg_len = strlen(response->message);
-    if (msg_len > 0 && msg_len < (sizeof(response_data) - 1)) {
-        memcpy(&response_data[1], response->message, msg_len);
+    if (msg_len > sizeof(response_data) - 2) {
+        msg_len = sizeof(response_data) - 2;
     }
+    memcpy(&response_data[1], response->message, msg_len);
+    response_data[1 + msg_len] = ETX_TERMINATOR[0];
     
     raw_hid_send(response_data, response_length);
     
@@ -115,6 +119,22 @@ bool field_kit_handle_command(const char *command, field_kit_response_t *respons
             response->status = RESPONSE_OK;
             return true;
             
+        case CMD_ALL_INFO:
+            // Answer with one report per record: firmware info and side info
+            // are sent here, the status report is sent by the caller
+            field_kit_get_firmware_info(response->message, sizeof(response->message));
+            response->status = RESPONSE_INFO;
+            field_kit_send_response(response, 0);
+            
+            memset(response->message, 0, sizeof(response->message));
+            field_kit_get_side_info(response->message, sizeof(response->message));
+            field_kit_send_response(response, 0);
+            
+            memset(response->message, 0, sizeof(response->message));
+            strcpy(response->message, "Field Kit active");
+            response->status = RESPONSE_OK;
+            return true;
+            
         case CMD_UNKNOWN:
         default:
             strcpy(response->message, "Unknown command");
@@ -24,6 +24,7 @@ typedef enum {
     CMD_FIRMWARE_INFO,
     CMD_SIDE_INFO,
     CMD_STATUS,
+    CMD_ALL_INFO,
     CMD_UNKNOWN
 } field_kit_command_t;
 
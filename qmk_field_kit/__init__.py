@@ -10,15 +10,25 @@ Modules:
 - bootloader: Handle MCU-specific bootloader entry methods
 - flash: Manage side selection and firmware flashing logic
 - cli: Command-line interface and main entry point
+- cache: On-disk caches for detected features and build state
 """
 
 __version__ = "1.0.0"
 __author__ = "QMK Field Kit"
 
-from .features import get_features, FeatureDetector
-from .bootloader import enter_bootloader, BootloaderManager
-from .flash import flash_keyboard, FlashManager
-from .cli import main
+import importlib
+
+# Public name -> submodule that defines it. Submodules are imported on first
+# access (PEP 562) so that e.g. "--help" does not load hidapi.
+_LAZY_ATTRS = {
+    'get_features': 'features',
+    'FeatureDetector': 'features',
+    'enter_bootloader': 'bootloader',
+    'BootloaderManager': 'bootloader',
+    'flash_keyboard': 'flash',
+    'FlashManager': 'flash',
+    'main': 'cli',
+}
 
 __all__ = [
     'get_features',
@@ -28,4 +38,18 @@ __all__ = [
     'flash_keyboard',
     'FlashManager',
     'main'
-]
\ No newline at end of file
+]
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = importlib.import_module(f".{_LAZY_ATTRS[name]}", __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,18 +1,75 @@
 #!/usr/bin/env python3
 
+import os
 import time
+import functools
+import select
 import platform
-import subprocess
-from typing import Optional, List
+import threading
+from typing import Optional, List, Callable, NamedTuple
 from pathlib import Path
-from .hid_comm import HIDCommunicator, HID_AVAILABLE
+from .hid_comm import HIDCommunicator, hid_available
+
+# pyudev delivers USB hotplug events on Linux; fall back to scanning sysfs
+try:
+    import pyudev
+    PYUDEV_AVAILABLE = True
+except ImportError:
+    PYUDEV_AVAILABLE = False
+
+# USB identifiers of the RP2040 boot ROM ("RP2 Boot")
+RP2_BOOT_VENDOR_ID = '2e8a'
+RP2_BOOT_PRODUCT_ID = '0003'
+
+# platform.system() does not change while running, so resolve it once
+_SYSTEM = platform.system()
+
+SYSFS_USB_DEVICES = Path("/sys/bus/usb/devices")
+RPI_RP2_DRIVE = Path("/Volumes/RPI-RP2")
+
+
+def _rp2_boot_in_sysfs() -> bool:
+    """Check sysfs for an RP2040 in bootloader mode."""
+    for vendor_file in SYSFS_USB_DEVICES.glob("*/idVendor"):
+        try:
+            if (vendor_file.read_text().strip() == RP2_BOOT_VENDOR_ID and
+                    (vendor_file.parent / "idProduct").read_text().strip() == RP2_BOOT_PRODUCT_ID):
+                return True
+        except OSError:
+            continue
+    return False
+
+
+class _DeviceWatch(NamedTuple):
+    """A running watcher for the bootloader device."""
+    is_present: Callable[[], bool]
+    wakeup: threading.Event
+    stop: Callable[[], None]
 
 
 class BootloaderManager:
     """Handles bootloader entry for different MCU families."""
     
-    def __init__(self):
-        self.system = platform.system()
+    def __init__(self, verbose: bool = False, comm: Optional[HIDCommunicator] = None):
+        self.system = _SYSTEM
+        self.verbose = verbose
+        # Connection to reuse for HID bootloader entry; a new one is opened if None
+        self.comm = comm
+        self._mcu_handlers = {
+            'rp2040': self._enter_rp2040_bootloader,
+            'avr': self._enter_avr_bootloader,
+            'arm': self._enter_arm_bootloader,
+        }
+        self._watch_impls = {
+            'Darwin': self._watch_macos_bootloader_device,
+            'Linux': self._watch_linux_bootloader_device,
+        }
+        self._wait_impls = {
+            'Darwin': self._wait_for_macos_bootloader_device,
+            'Linux': self._wait_for_linux_bootloader_device,
+        }
+        # (mcu_family, transport_protocol) -> resolved entry routine, or None
+        self._strategies = {}
     
     def enter_bootloader(self, mcu_family: str, transport_protocol: str = 'serial') -> bool:
         """
@@ -25,47 +82,60 @@ class BootloaderManager:
         Returns:
             True if bootloader entry was successful or attempted
         """
-        if mcu_family == 'rp2040':
-            return self._enter_rp2040_bootloader(transport_protocol)
-        elif mcu_family == 'avr':
-            return self._enter_avr_bootloader()
-        elif mcu_family == 'arm':
-            return self._enter_arm_bootloader()
-        else:
+        strategy = self.get_strategy(mcu_family, transport_protocol)
+        if strategy is None:
             print(f"Warning: Unknown MCU family '{mcu_family}', skipping bootloader entry")
             return True
+        return strategy()
+    
+    def get_strategy(self, mcu_family: str, transport_protocol: str = 'serial') -> Optional[Callable[[], bool]]:
+        """
+        Get the bootloader entry routine for an MCU family and transport.
+        
+        The routine is resolved once per (mcu_family, transport_protocol)
+        and cached. Returns None for unknown MCU families.
+        """
+        key = (mcu_family, transport_protocol)
+        if key not in self._strategies:
+            handler = self._mcu_handlers.get(mcu_family)
+            self._strategies[key] = functools.partial(handler, transport_protocol) if handler else None
+        return self._strategies[key]
     
     def _enter_rp2040_bootloader(self, transport_protocol: str = 'serial') -> bool:
         """Enter bootloader mode for RP2040 via HID commands."""
         
-        # Try HID communication first
-        if HID_AVAILABLE:
-            print("Attempting HID bootloader entry...")
-            if self._try_hid_bootloader_entry():
-                return self._wait_for_bootloader_device()
+        # Start watching before triggering so a fast re-enumeration is not missed
+        watch = self._watch_for_bootloader_device()
+        try:
+            # Try HID communication first
+            if hid_available():
+                print("Attempting HID bootloader entry...")
+                if self._try_hid_bootloader_entry():
+                    return self._wait_for_bootloader_device(watch=watch)
+                
+                # HID failed, show manual instructions
+                print("HID bootloader entry not available")
+            else:
+                # HID library not available, show manual instructions
+                print("HID library not available")
             
-            # HID failed, show manual instructions
-            print("HID bootloader entry not available")
             print("Please manually enter bootloader mode:")
             print("  1. Hold the BOOT button on the keyboard")
             print("  2. Press and release the RESET button") 
             print("  3. Release the BOOT button")
-            return self._wait_for_bootloader_device()
-        else:
-            # HID library not available, show manual instructions
-            print("HID library not available")
-            print("Please manually enter bootloader mode:")
-            print("  1. Hold the BOOT button on the keyboard")
-            print("  2. Press and release the RESET button") 
-            print("  3. Release the BOOT button")
-            return self._wait_for_bootloader_device()
+            return self._wait_for_bootloader_device(watch=watch)
+        finally:
+            if watch:
+                watch.stop()
     
     def _try_hid_bootloader_entry(self) -> bool:
         """Try to trigger bootloader via HID communication."""
         try:
-            comm = HIDCommunicator()
+            comm = self.comm or HIDCommunicator()
             
-            if comm.connect():
+            # Reuse the connection if it is already open; sending reopens it
+            # if the keyboard re-enumerated since
+            if comm.device is not None or comm.connect():
                 success = comm.trigger_bootloader()
                 comm.disconnect()
                 return success
@@ -77,68 +147,165 @@ class BootloaderManager:
             print(f"HID bootloader entry failed: {e}")
             return False
     
-    def _enter_avr_bootloader(self) -> bool:
+    def _enter_avr_bootloader(self, transport_protocol: str = 'serial') -> bool:
         """Enter bootloader mode for AVR MCUs."""
         print("AVR bootloader entry not implemented yet")
         print("Please manually enter bootloader mode")
         return True
     
-    def _enter_arm_bootloader(self) -> bool:
+    def _enter_arm_bootloader(self, transport_protocol: str = 'serial') -> bool:
         """Enter bootloader mode for ARM MCUs."""
         print("ARM bootloader entry not implemented yet") 
         print("Please manually enter bootloader mode")
         return True
     
     
-    def _wait_for_bootloader_device(self, timeout: int = 30) -> bool:
-        """Wait for bootloader device to appear."""
+    def _watch_for_bootloader_device(self) -> Optional[_DeviceWatch]:
+        """Start watching for the bootloader device, if supported on this platform."""
+        watch_impl = self._watch_impls.get(self.system)
+        return watch_impl() if watch_impl else None
+    
+    def _watch_macos_bootloader_device(self) -> _DeviceWatch:
+        """Watch /Volumes for the RPI-RP2 drive."""
+        changed = threading.Event()
+        return _DeviceWatch(RPI_RP2_DRIVE.exists, changed,
+                            self._watch_directory(RPI_RP2_DRIVE.parent, changed))
+    
+    def _watch_linux_bootloader_device(self) -> _DeviceWatch:
+        """Watch USB hotplug events for the RP2 Boot device."""
+        arrived = threading.Event()
+        return _DeviceWatch(_rp2_boot_in_sysfs, arrived, self._watch_usb_hotplug(arrived))
+    
+    def _wait_for_bootloader_device(self, timeout: int = 30, watch: Optional[_DeviceWatch] = None) -> bool:
+        """
+        Wait for bootloader device to appear.
+        
+        Args:
+            timeout: Seconds to wait before giving up
+            watch: Watcher started before the bootloader was triggered; a new
+                one is started (and stopped) here if omitted
+        """
         print(f"Waiting for bootloader device to appear (timeout: {timeout}s)...")
         
-        if self.system == "Darwin":  # macOS
-            return self._wait_for_macos_bootloader_device(timeout)
-        elif self.system == "Linux":
-            return self._wait_for_linux_bootloader_device(timeout)
-        else:
+        wait_impl = self._wait_impls.get(self.system)
+        if wait_impl is None:
             print(f"Bootloader detection not implemented for {self.system}")
             print("Please verify bootloader device is ready and press Enter to continue...")
             input()
             return True
+        return wait_impl(timeout, watch)
     
-    def _wait_for_macos_bootloader_device(self, timeout: int) -> bool:
+    def _wait_for_macos_bootloader_device(self, timeout: int, watch: Optional[_DeviceWatch] = None) -> bool:
         """Wait for RPI-RP2 drive to appear on macOS."""
-        drive_path = Path("/Volumes/RPI-RP2")
-        start_time = time.time()
-        
-        while time.time() - start_time < timeout:
-            if drive_path.exists():
-                print(f"RPI-RP2 drive detected at {drive_path}!")
-                return True
-            print(".", end="", flush=True)
-            time.sleep(0.5)
+        if self._wait_with_watch(timeout, watch):
+            print(f"RPI-RP2 drive detected at {RPI_RP2_DRIVE}!")
+            return True
         
         print(f"\nTimeout waiting for RPI-RP2 drive after {timeout}s")
         return False
     
-    def _wait_for_linux_bootloader_device(self, timeout: int) -> bool:
+    def _wait_for_linux_bootloader_device(self, timeout: int, watch: Optional[_DeviceWatch] = None) -> bool:
         """Wait for bootloader device on Linux."""
-        start_time = time.time()
-        
-        while time.time() - start_time < timeout:
-            # Check for RP2040 in bootloader mode
-            try:
-                result = subprocess.run(['lsusb'], capture_output=True, text=True)
-                if 'Raspberry Pi' in result.stdout and 'RP2 Boot' in result.stdout:
-                    print("RP2040 bootloader device detected!")
-                    return True
-            except subprocess.CalledProcessError:
-                pass
-            
-            print(".", end="", flush=True)
-            time.sleep(0.5)
+        if self._wait_with_watch(timeout, watch):
+            print("RP2040 bootloader device detected!")
+            return True
         
         print(f"\nTimeout waiting for bootloader device after {timeout}s")
         return False
     
+    def _wait_with_watch(self, timeout: int, watch: Optional[_DeviceWatch]) -> bool:
+        """Wait on an existing watcher, or on a temporary one if none is given."""
+        if watch is not None:
+            return self._wait_for_device(watch, timeout)
+        
+        watch = self._watch_for_bootloader_device()
+        try:
+            return self._wait_for_device(watch, timeout)
+        finally:
+            watch.stop()
+    
+    def _wait_for_device(self, watch: _DeviceWatch, timeout: float) -> bool:
+        """
+        Wait until the watched device is present or the timeout expires.
+        
+        The check is repeated as soon as the watcher signals a change, and at
+        least every 0.5s in case no event source is available.
+        """
+        deadline = time.monotonic() + timeout
+        
+        while not watch.is_present():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if watch.wakeup.wait(min(0.5, remaining)):
+                watch.wakeup.clear()
+            elif self.verbose:
+                print(".", end="", flush=True)
+        
+        return True
+    
+    def _watch_directory(self, path: Path, changed: threading.Event) -> Callable[[], None]:
+        """
+        Set changed whenever entries are added to or removed from path.
+        
+        Uses a kqueue vnode watch where available (macOS). Returns a function
+        that stops watching.
+        """
+        if not hasattr(select, 'kqueue'):
+            return lambda: None
+        
+        try:
+            fd = os.open(str(path), getattr(os, 'O_EVTONLY', os.O_RDONLY))
+        except OSError:
+            return lambda: None
+        
+        kq = select.kqueue()
+        kq.control([select.kevent(fd, filter=select.KQ_FILTER_VNODE,
+                                  flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                                  fflags=select.KQ_NOTE_WRITE)], 0, 0)
+        stopped = threading.Event()
+        
+        def watch():
+            try:
+                while not stopped.is_set():
+                    if kq.control(None, 1, 0.5):
+                        changed.set()
+            finally:
+                kq.close()
+                os.close(fd)
+        
+        threading.Thread(target=watch, name="volume-watcher", daemon=True).start()
+        return stopped.set
+    
+    def _watch_usb_hotplug(self, arrived: threading.Event) -> Callable[[], None]:
+        """
+        Set arrived when an RP2 Boot device is plugged in.
+        
+        Uses udev hotplug events when pyudev is installed. Returns a function
+        that stops watching.
+        """
+        if not PYUDEV_AVAILABLE:
+            return lambda: None
+        
+        def on_device(device):
+            if (device.action == 'add' and
+                    device.get('ID_VENDOR_ID') == RP2_BOOT_VENDOR_ID and
+                    device.get('ID_MODEL_ID') == RP2_BOOT_PRODUCT_ID):
+                arrived.set()
+        
+        # pyudev loads libudev lazily and netlink sockets may be unavailable
+        # (minimal containers, WSL); fall back to polling sysfs then
+        try:
+            context = pyudev.Context()
+            monitor = pyudev.Monitor.from_netlink(context)
+            monitor.filter_by('usb', device_type='usb_device')
+            observer = pyudev.MonitorObserver(monitor, callback=on_device, name="usb-watcher")
+            observer.daemon = True
+            observer.start()
+        except (ImportError, OSError):
+            return lambda: None
+        return observer.send_stop
+    
     def wait_for_device_ready(self, mcu_family: str) -> bool:
         """Wait for the device to be ready for flashing."""
         if mcu_family == 'rp2040':
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import tempfile
+from pathlib import Path
+from typing import Any, Optional
+
+# Use orjson for faster JSON parsing when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+def cache_dir() -> Path:
+    """Directory for QMK Field Kit's on-disk caches."""
+    cache_home = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / ".cache")
+    return cache_home / "qmk_field_kit"
+
+
+def load_json(path: Path) -> Optional[Any]:
+    """Load a JSON cache file, returning None if it is missing or corrupt."""
+    try:
+        return json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def store_json(path: Path, data: Any) -> None:
+    """
+    Atomically write a JSON cache file.
+
+    The data is written to a temporary file in the same directory and moved
+    into place, so readers never see a partial file. Failures are ignored
+    since the cache is only an optimization.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
@@ -1,20 +1,21 @@
 #!/usr/bin/env python3
 
 import sys
+import json
+import logging
 import argparse
-from typing import Optional
+from typing import Optional, Dict, Any
 
 from .features import get_features, FeatureDetector
 from .flash import FlashManager
 from .bootloader import BootloaderManager
-from .hid_comm import HIDCommunicator, HID_AVAILABLE
+from .hid_comm import HIDCommunicator, hid_available
 
+logger = logging.getLogger(__name__)
 
-def main():
-    """Main CLI entry point for QMK Field Kit."""
-    import sys
-    print(f"DEBUG: CLI main() called with sys.argv: {sys.argv}")
-    print("DEBUG: About to create argument parser")
+
+def _build_parser() -> argparse.ArgumentParser:
+    """Build the command-line argument parser."""
     parser = argparse.ArgumentParser(
         description="QMK Field Kit - Advanced flashing utility for QMK keyboards",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -70,22 +71,51 @@ Examples:
         help='Force flash to specified side (bypasses side lock checks)'
     )
     
+    parser.add_argument(
+        '--clean',
+        action='store_true',
+        help='Run qmk clean before building even if nothing changed since the last build'
+    )
+    
     parser.add_argument(
         '--verbose',
         action='store_true',
         help='Enable verbose output'
     )
     
+    return parser
+
+
+_PARSER = _build_parser()
+
+
+def main():
+    """Main CLI entry point for QMK Field Kit."""
+    parser = _PARSER
     args = parser.parse_args()
     
+    # Diagnostics are only formatted and written when --verbose is given
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(levelname)s: %(message)s")
+    logger.debug("CLI main() called with sys.argv: %s", sys.argv)
+    
     # Determine if side was explicitly provided
     explicit_side = args.side is not None
     
     try:
+        # Detect features once and share them with the commands that need them
+        features = None
+        if args.info or args.bootloader:
+            try:
+                features = get_features(args.keyboard)
+            except Exception as e:
+                print(f"Error detecting features: {e}")
+                return 1
+        
         if args.info:
-            return show_info(args.keyboard, args.verbose)
+            return show_info(args.keyboard, args.verbose, features)
         elif args.bootloader:
-            return enter_bootloader_only(args.keyboard)
+            return enter_bootloader_only(args.keyboard, features, args.verbose)
         elif args.validate:
             return validate_environment()
         elif args.hid_test:
@@ -94,19 +124,20 @@ Examples:
             # If no side specified, check if we can use side lock
             if args.side is None:
                 try:
+                    # Detected features are cached, and passed on to flashing below
                     features = get_features(args.keyboard)
-                    if not features.get('side_lock_enabled', False):
-                        parser.print_help()
-                        print("\nError: No side specified. Use 'left' or 'right' argument.")
-                        return 1
-                    # Side lock is enabled, let it determine the side
-                    args.side = 'auto'  # Special value for auto-detection
                 except Exception as e:
                     parser.print_help()
                     print(f"\nError: Cannot determine side lock status: {e}")
                     return 1
+                if not features.get('side_lock_enabled', False):
+                    parser.print_help()
+                    print("\nError: No side specified. Use 'left' or 'right' argument.")
+                    return 1
+                # Side lock is enabled, let it determine the side
+                args.side = 'auto'  # Special value for auto-detection
             
-            return flash_keyboard_main(args.side, args.keyboard, args.verbose, explicit_side, args.force)
+            return flash_keyboard_main(args.side, args.keyboard, args.verbose, explicit_side, args.force, features, args.clean)
     
     except KeyboardInterrupt:
         print("\nOperation cancelled by user")
@@ -119,13 +150,14 @@ Examples:
         return 1
 
 
-def show_info(keyboard: Optional[str] = None, verbose: bool = False) -> int:
+def show_info(keyboard: Optional[str] = None, verbose: bool = False, features: Optional[Dict[str, Any]] = None) -> int:
     """Show keyboard information and detected features."""
-    try:
-        features = get_features(keyboard)
-    except Exception as e:
-        print(f"Error detecting features: {e}")
-        return 1
+    if features is None:
+        try:
+            features = get_features(keyboard)
+        except Exception as e:
+            print(f"Error detecting features: {e}")
+            return 1
     
     print(f"Keyboard: {features['keyboard']}")
     print(f"Path: {features['keyboard_path']}")
@@ -141,19 +173,19 @@ def show_info(keyboard: Optional[str] = None, verbose: bool = False) -> int:
     
     if verbose:
         print("\nAll detected features:")
-        import pprint
-        pprint.pprint(features, indent=2)
+        print(json.dumps(features, indent=2, default=str, sort_keys=True))
     
     return 0
 
 
-def enter_bootloader_only(keyboard: Optional[str] = None) -> int:
+def enter_bootloader_only(keyboard: Optional[str] = None, features: Optional[Dict[str, Any]] = None, verbose: bool = False) -> int:
     """Enter bootloader mode without flashing."""
-    try:
-        features = get_features(keyboard)
-    except Exception as e:
-        print(f"Error detecting features: {e}")
-        return 1
+    if features is None:
+        try:
+            features = get_features(keyboard)
+        except Exception as e:
+            print(f"Error detecting features: {e}")
+            return 1
     
     if not features['mcu_family']:
         print("Warning: Unknown MCU family, cannot auto-enter bootloader")
@@ -162,7 +194,7 @@ def enter_bootloader_only(keyboard: Optional[str] = None) -> int:
     
     print(f"Entering bootloader mode for {features['mcu_family']}...")
     
-    manager = BootloaderManager()
+    manager = BootloaderManager(verbose)
     success = manager.enter_bootloader(
         features['mcu_family'],
         features.get('transport_protocol', 'serial')
@@ -189,16 +221,16 @@ def validate_environment() -> int:
         return 1
 
 
-def flash_keyboard_main(side: str, keyboard: Optional[str] = None, verbose: bool = False, explicit_side: bool = False, force: bool = False) -> int:
+def flash_keyboard_main(side: str, keyboard: Optional[str] = None, verbose: bool = False, explicit_side: bool = False, force: bool = False, features: Optional[Dict[str, Any]] = None, clean: bool = False) -> int:
     """Main keyboard flashing function."""
-    manager = FlashManager()
+    manager = FlashManager(verbose)
     
     # Validate environment first
     if not manager.validate_flash_environment():
         return 1
     
     # Perform the flash
-    success = manager.flash_keyboard(side, keyboard, explicit_side, force)
+    success = manager.flash_keyboard(side, keyboard, explicit_side, force, features, clean)
     
     return 0 if success else 1
 
@@ -208,7 +240,7 @@ def test_hid_communication() -> int:
     print("QMK Field Kit HID Communication Test")
     print("=====================================")
     
-    if not HID_AVAILABLE:
+    if not hid_available():
         print("❌ HID library not available")
         print("   Install with: pip install hidapi")
         return 1
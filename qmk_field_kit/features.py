@@ -1,10 +1,75 @@
 #!/usr/bin/env python3
 
 import json
+import os
 import re
 import subprocess
+import configparser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Iterable, Iterator, Tuple
+
+from .cache import cache_dir, json_loads, load_json, store_json
+
+# Matches "include <path>" or "KEY = VALUE" / "KEY := VALUE" lines in rules.mk,
+# ignoring surrounding whitespace and trailing comments
+RULES_RE = re.compile(
+    r'^[ \t]*(?:include[ \t]+(\S+)|([A-Za-z_][A-Za-z0-9_]*)[ \t]*:?=[ \t]*(.*?))[ \t]*(?:#.*)?$',
+    re.MULTILINE
+)
+
+# MCU family for each supported bootloader
+BOOTLOADER_TO_FAMILY = {
+    'rp2040': 'rp2040',
+    'atmel-dfu': 'avr',
+    'caterina': 'avr',
+    'halfkay': 'avr',
+    'stm32-dfu': 'arm',
+    'stm32duino': 'arm',
+}
+
+# Directories that identify the root of a qmk_firmware checkout
+QMK_ROOT_MARKERS = frozenset({'quantum', 'keyboards'})
+
+# Format of on-disk feature cache entries. Bump whenever detection or
+# rules.mk parsing changes, so entries written by older code are discarded.
+FEATURES_CACHE_VERSION = 1
+
+
+def _mtime(path: Path) -> Optional[int]:
+    """Return the modification time of a file, or None if it is missing."""
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _sources_unchanged(sources: Dict[str, Optional[int]]) -> bool:
+    """Check that every recorded source file still has its recorded mtime."""
+    return all(_mtime(Path(path)) == mtime for path, mtime in sources.items())
+
+
+def _qmk_ini_paths() -> List[Path]:
+    """Candidate locations of the QMK CLI configuration file."""
+    config_home = Path(os.environ.get('XDG_CONFIG_HOME') or Path.home() / ".config")
+    return [
+        config_home / "qmk" / "qmk.ini",
+        Path.home() / "Library" / "Application Support" / "qmk" / "qmk.ini",  # macOS
+    ]
+
+
+def read_qmk_user_config() -> Dict[str, str]:
+    """Read the [user] section of qmk.ini without spawning the qmk CLI."""
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        parser.read(_qmk_ini_paths())
+    except configparser.Error:
+        return {}
+
+    if not parser.has_section('user'):
+        return {}
+    # Unset options are stored as the string "None"
+    return {key: value for key, value in parser.items('user') if value and value != 'None'}
 
 
 class FeatureDetector:
@@ -12,24 +77,42 @@ class FeatureDetector:
 
     def __init__(self):
         self.qmk_root = self._find_qmk_root()
+        self._current_keyboard = None
+        # keyboard_path -> (source mtimes, detected features)
+        self._features_cache = {}
 
     def _find_qmk_root(self) -> Path:
         """Find QMK firmware root directory."""
         current = Path.cwd()
         while current.parent != current:
-            if (current / "quantum").is_dir() and (current / "keyboards").is_dir():
+            # One directory read per level; DirEntry.is_dir() uses the cached d_type
+            try:
+                with os.scandir(current) as entries:
+                    subdirs = {entry.name for entry in entries if entry.is_dir()}
+            except OSError:
+                subdirs = set()
+            if QMK_ROOT_MARKERS <= subdirs:
                 return current
             current = current.parent
         return Path.cwd()
 
     def get_current_keyboard(self) -> str:
         """Get currently selected keyboard from qmk config."""
-        try:
-            result = subprocess.run(['qmk', 'config', 'user.keyboard'],
-                                  capture_output=True, text=True, check=True)
-            return result.stdout.strip().split('=')[1]
-        except (subprocess.CalledProcessError, IndexError):
-            raise RuntimeError("Could not determine current keyboard from qmk config")
+        if self._current_keyboard is not None:
+            return self._current_keyboard
+
+        # Reading qmk.ini directly avoids the startup cost of the qmk CLI
+        keyboard = read_qmk_user_config().get('keyboard')
+        if keyboard is None:
+            try:
+                result = subprocess.run(['qmk', 'config', 'user.keyboard'],
+                                      capture_output=True, text=True, check=True)
+                keyboard = result.stdout.strip().split('=')[1]
+            except (subprocess.CalledProcessError, IndexError, OSError):
+                raise RuntimeError("Could not determine current keyboard from qmk config")
+
+        self._current_keyboard = keyboard
+        return self._current_keyboard
 
     def get_keyboard_path(self, keyboard: Optional[str] = None) -> Path:
         """Get path to keyboard directory."""
@@ -43,50 +126,113 @@ class FeatureDetector:
         if not keyboard_json.exists():
             return {}
 
-        with open(keyboard_json, 'r') as f:
-            return json.load(f)
+        return json_loads(keyboard_json.read_bytes())
+
+    def _iter_rules(self, rules_mk: Path, reverse: bool = False,
+                    sources: Optional[List[Path]] = None) -> Iterator[Tuple[str, str]]:
+        """
+        Yield (KEY, VALUE) assignments from a makefile, expanding includes in place.
+
+        With reverse=True statements are produced from last to first, so the
+        first assignment seen for a key is the one that takes effect. Included
+        paths, including ones that do not exist, are appended to sources.
+        """
+        def statements(path: Path):
+            text = path.read_text()
+            if reverse:
+                return reversed(RULES_RE.findall(text))
+            return (match.groups() for match in RULES_RE.finditer(text))
+
+        # Files currently being expanded. Like make, a file included several
+        # times is expanded every time; only include cycles are skipped.
+        root = rules_mk.resolve()
+        active = {root}
+        stack = [(root, statements(rules_mk))]
+
+        while stack:
+            current, pending = stack[-1]
+            statement = next(pending, None)
+            if statement is None:
+                stack.pop()
+                active.discard(current)
+                continue
+
+            include_path, key, value = statement
 
-    def parse_rules_mk(self, keyboard_path: Path) -> Dict[str, str]:
-        """Parse rules.mk file for KEY=VALUE pairs."""
+            # Handle include statements
+            if include_path:
+                include_full_path = (current.parent / include_path).resolve()
+                # Record missing includes too, so creating one later is noticed
+                if sources is not None:
+                    sources.append(include_full_path)
+                if include_full_path not in active and include_full_path.is_file():
+                    active.add(include_full_path)
+                    stack.append((include_full_path, statements(include_full_path)))
+                continue
+
+            yield key, value
+
+    def parse_rules_mk(self, keyboard_path: Path, sources: Optional[List[Path]] = None) -> Dict[str, str]:
+        """
+        Parse rules.mk file for KEY=VALUE pairs.
+
+        Included makefiles are expanded in place, so assignments that follow
+        an include override the values it sets. The paths of included files
+        are appended to sources, if given.
+        """
         rules_mk = keyboard_path / "rules.mk"
-        features = {}
+        if not rules_mk.exists():
+            return {}
+
+        return dict(self._iter_rules(rules_mk, sources=sources))
 
+    def probe_rules(self, keyboard_path: Path, keys: Iterable[str]) -> Dict[str, str]:
+        """
+        Look up only the given keys in rules.mk.
+
+        Cheaper than parse_rules_mk() when a few values are needed: scanning
+        stops as soon as the effective value of every key is known.
+        """
+        rules_mk = keyboard_path / "rules.mk"
+        found = {}
         if not rules_mk.exists():
-            return features
-
-        with open(rules_mk, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-
-                # Handle include statements
-                if line.startswith('include '):
-                    include_path = line.split(' ', 1)[1]
-                    include_full_path = keyboard_path / include_path
-                    if include_full_path.exists():
-                        included_features = self.parse_rules_mk(include_full_path.parent)
-                        features.update(included_features)
-                    continue
-
-                # Parse KEY = VALUE pairs
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    features[key.strip()] = value.strip()
+            return found
 
-        return features
+        wanted = set(keys)
+        for key, value in self._iter_rules(rules_mk, reverse=True):
+            if key in wanted:
+                found[key] = value
+                wanted.discard(key)
+                if not wanted:
+                    break
+
+        return found
 
     def detect_features(self, keyboard: Optional[str] = None) -> Dict[str, Any]:
-        """Detect all features for the specified keyboard."""
-        keyboard_path = self.get_keyboard_path(keyboard)
+        """
+        Detect all features for the specified keyboard.
+
+        Results are cached in memory and on disk, and reused until
+        keyboard.json, rules.mk or any makefile it includes is modified.
+        """
+        resolved = keyboard or self.get_current_keyboard()
+        keyboard_path = self.qmk_root / "keyboards" / resolved
 
-        # Parse both keyboard.json and rules.mk
-        json_config = self.parse_keyboard_json(keyboard_path)
-        rules_config = self.parse_rules_mk(keyboard_path)
+        cached = self._features_cache.get(str(keyboard_path)) or self._load_cached(resolved, keyboard_path)
+        if cached is not None and _sources_unchanged(cached[0]):
+            self._features_cache[str(keyboard_path)] = cached
+            return cached[1]
+
+        # Parse keyboard.json and rules.mk concurrently so their file I/O overlaps
+        includes = []
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            json_future = pool.submit(self.parse_keyboard_json, keyboard_path)
+            rules_future = pool.submit(self.parse_rules_mk, keyboard_path, includes)
+            json_config, rules_config = json_future.result(), rules_future.result()
 
         # Combine and normalize features
         features = {
-            'keyboard': keyboard or self.get_current_keyboard(),
+            'keyboard': resolved,
             'keyboard_path': str(keyboard_path),
             'bootloader': json_config.get('bootloader', 'unknown'),
             'split_enabled': json_config.get('split', {}).get('enabled', False),
@@ -105,24 +251,61 @@ class FeatureDetector:
             features['transport_protocol'] = transport.get('protocol', 'serial')
 
         # Detect MCU family from bootloader
-        bootloader = features['bootloader']
-        if bootloader in ['rp2040']:
-            features['mcu_family'] = 'rp2040'
-        elif bootloader in ['atmel-dfu', 'caterina', 'halfkay']:
-            features['mcu_family'] = 'avr'
-        elif bootloader in ['stm32-dfu', 'stm32duino']:
-            features['mcu_family'] = 'arm'
+        features['mcu_family'] = BOOTLOADER_TO_FAMILY.get(features['bootloader'])
 
+        source_files = [keyboard_path / "keyboard.json", keyboard_path / "rules.mk"] + includes
+        sources = {str(path): _mtime(path) for path in source_files}
+        self._features_cache[str(keyboard_path)] = (sources, features)
+        self._store_cached(resolved, sources, features)
         return features
 
+    def _cache_file(self, keyboard: str) -> Path:
+        """On-disk cache file for a keyboard's detected features."""
+        return cache_dir() / f"{keyboard.replace('/', '_')}.json"
+
+    def _load_cached(self, keyboard: str, keyboard_path: Path) -> Optional[Tuple[Dict[str, Optional[int]], Dict[str, Any]]]:
+        """Load cached (sources, features) for a keyboard, if present."""
+        entry = load_json(self._cache_file(keyboard))
+        if (not isinstance(entry, dict) or entry.get('version') != FEATURES_CACHE_VERSION
+                or entry.get('keyboard_path') != str(keyboard_path)):
+            return None
+        try:
+            return entry['sources'], entry['features']
+        except KeyError:
+            return None
+
+    def _store_cached(self, keyboard: str, sources: Dict[str, Optional[int]], features: Dict[str, Any]) -> None:
+        """Persist detected features along with the mtimes they were parsed from."""
+        store_json(self._cache_file(keyboard), {
+            'version': FEATURES_CACHE_VERSION,
+            'keyboard_path': features['keyboard_path'],
+            'sources': sources,
+            'features': features,
+        })
+
+
+_detector_singleton: Optional[FeatureDetector] = None
+
+
+def _get_detector() -> FeatureDetector:
+    """Return the detector shared by the convenience functions."""
+    global _detector_singleton
+    if _detector_singleton is None:
+        _detector_singleton = FeatureDetector()
+    return _detector_singleton
+
 
 def get_features(keyboard: Optional[str] = None) -> Dict[str, Any]:
     """Convenience function to get features for a keyboard."""
-    detector = FeatureDetector()
-    return detector.detect_features(keyboard)
+    return _get_detector().detect_features(keyboard)
+
+
+def probe_rules(keys: Iterable[str], keyboard: Optional[str] = None) -> Dict[str, str]:
+    """Convenience function to look up a few rules.mk values for a keyboard."""
+    detector = _get_detector()
+    return detector.probe_rules(detector.get_keyboard_path(keyboard), keys)
 
 
 if __name__ == "__main__":
     features = get_features()
-    import pprint
-    pprint.pprint(features)
+    print(json.dumps(features, indent=2, default=str, sort_keys=True))
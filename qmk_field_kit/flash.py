@@ -1,24 +1,151 @@
 #!/usr/bin/env python3
 
+import os
+import json
+import shlex
+import hashlib
+import logging
+import functools
 import subprocess
-import platform
-import shutil
 from pathlib import Path
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
 
-from .features import get_features
+from .cache import cache_dir, load_json, store_json
+from .features import get_features, read_qmk_user_config
 from .bootloader import BootloaderManager
-from .hid_comm import HIDCommunicator
+from .hid_comm import HIDCommunicator, get_shared_hid
+
+# Sides a split keyboard can be flashed as; "auto" lets side lock decide
+SIDES = frozenset({'left', 'right'})
+REQUESTED_SIDES = SIDES | {'auto'}
+
+logger = logging.getLogger(__name__)
+
+# Compiler flags that select the master/EEPROM side of a split keyboard
+_SIDE_FLAGS = {
+    'left': "-DMASTER_LEFT -DINIT_EE_HANDS_LEFT",
+    'right': "-DMASTER_RIGHT -DINIT_EE_HANDS_RIGHT",
+}
+
+# Shown under the "Flashing the *side* side" line
+SIDE_INDICATORS = {
+    'left': "<----------------------- The one over here",
+    'right': "The one over there ---------------------->",
+}
+
+# Last build inputs per keymap directory, used to skip needless `qmk clean`s
+BUILD_HASHES_FILE = "build_hashes.json"
+
+
+def _file_digest(path: str) -> bytes:
+    """BLAKE2b digest of a file's contents, read in C where supported."""
+    with open(path, 'rb') as f:
+        # hashlib.file_digest() (Python 3.11+) reads into a reused buffer
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'blake2b').digest()
+        hasher = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            hasher.update(chunk)
+        return hasher.digest()
+
+
+def _hash_tree(root: Path) -> str:
+    """Hash the relative paths and contents of every file under root."""
+    hasher = hashlib.blake2b()
+    
+    def visit(path: str, prefix: str):
+        # DirEntry.is_dir()/is_file() use the type from the directory read
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            name = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                visit(entry.path, name + '/')
+            elif entry.is_file():
+                hasher.update(name.encode())
+                hasher.update(_file_digest(entry.path))
+    
+    visit(str(root), '')
+    return hasher.hexdigest()
+
+
+def _format_command(argv: List[str], env: Optional[Dict[str, str]] = None, cwd: Optional[Path] = None) -> str:
+    """Render a command, its extra environment and directory as an equivalent shell line."""
+    assignments = [f"{name}={shlex.quote(value)}" for name, value in (env or {}).items()]
+    line = " ".join(assignments + [shlex.join(argv)])
+    return f"cd {shlex.quote(str(cwd))} && {line}" if cwd is not None else line
+
+
+# (rp2040 bootloader, auto_bootloader, split_enabled) ->
+#     (flash command argv, its extra environment, post-bootloader command argv)
+# Fields: {jobs}, {side}, {bootloader}, {side_flag}, and for uf2conv.py
+# {filename}. Post commands deploying {filename} run from the QMK root.
+_FLASH_COMMANDS = {
+    # Single keyboard
+    (False, False, False): (('qmk', 'flash', '-j', '{jobs}'), {}, None),
+    (True, False, False): (('qmk', 'flash', '-j', '{jobs}'), {}, None),
+    (False, True, False): (('qmk', 'compile', '-j', '{jobs}'), {}, None),
+    (True, True, False): (('qmk', 'compile', '-j', '{jobs}'), {}, None),
+    # Split keyboard, traditional qmk flash approach
+    (True, False, True): (('qmk', 'flash', '-j', '{jobs}', '-bl', 'uf2-split-{side}'), {}, None),
+    (False, False, True): (('qmk', 'flash', '-j', '{jobs}', '-bl', '{bootloader}-split-{side}'), {}, None),
+    # Split keyboard, compile with the side's EXTRAFLAGS, then flash once the
+    # bootloader has been triggered: QMK's uf2conv.py --wait --deploy for
+    # rp2040, otherwise qmk flash
+    (True, True, True): (('qmk', 'compile', '-j', '{jobs}'), {'EXTRAFLAGS': '{side_flag}'},
+                         ('./util/uf2conv.py', '--wait', '--deploy', '{filename}')),
+    (False, True, True): (('qmk', 'compile', '-j', '{jobs}'), {'EXTRAFLAGS': '{side_flag}'},
+                          ('qmk', 'flash', '-j', '{jobs}', '-bl', '{bootloader}-split-{side}')),
+}
+
+
+@functools.lru_cache(maxsize=4)
+def _find_qmk_root(cwd: str) -> Optional[Path]:
+    """
+    Find the QMK firmware root containing util/uf2conv.py, starting at cwd.
+    
+    $QMK_HOME is used when set. The answer is fixed for a given working
+    directory, so it is cached per process.
+    """
+    qmk_home = os.environ.get('QMK_HOME')
+    if qmk_home:
+        return Path(qmk_home)
+    
+    current = cwd
+    while True:
+        if os.path.isfile(os.path.join(current, 'util', 'uf2conv.py')):
+            return Path(current)
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
 
 
 class FlashManager:
     """Manages firmware flashing for QMK keyboards."""
     
-    def __init__(self):
-        self.system = platform.system()
-        self.bootloader_manager = BootloaderManager()
+    def __init__(self, verbose: bool = False, comm: Optional[HIDCommunicator] = None):
+        # One HID connection serves side lock and bootloader entry
+        self.comm = comm if comm is not None else get_shared_hid()
+        self.bootloader_manager = BootloaderManager(verbose, comm=self.comm)
+        self.system = self.bootloader_manager.system
+        # Number of parallel make jobs for qmk compile/flash
+        self._jobs = os.cpu_count() or 1
+        # keyboard argument -> detected features, shared by validation and flashing
+        self._features_cache = {}
+        # user.* settings from the QMK CLI configuration, loaded on first use
+        self._qmk_cfg: Optional[Dict[str, str]] = None
+    
+    def _features(self, keyboard: Optional[str] = None) -> Dict[str, Any]:
+        """Get keyboard features, detecting them at most once per keyboard."""
+        if keyboard not in self._features_cache:
+            self._features_cache[keyboard] = get_features(keyboard)
+        return self._features_cache[keyboard]
     
-    def flash_keyboard(self, side: str = "right", keyboard: Optional[str] = None, explicit_side: bool = False, force: bool = False) -> bool:
+    def flash_keyboard(self, side: str = "right", keyboard: Optional[str] = None, explicit_side: bool = False, force: bool = False, features: Optional[Dict[str, Any]] = None, clean: bool = False) -> bool:
         """
         Flash the keyboard with automatic side detection and bootloader entry.
         
@@ -27,36 +154,72 @@ class FlashManager:
             keyboard: Keyboard to flash (defaults to current qmk config)
             explicit_side: True if side was explicitly provided by user (initial flash)
             force: True to bypass side lock checks and force flash to specified side
+            features: Previously detected keyboard features (detected if omitted)
+            clean: True to run qmk clean even if the build inputs are unchanged
         
         Returns:
             True if flash was successful
         """
-        print(f"DEBUG: FlashManager.flash_keyboard called with side='{side}', explicit_side={explicit_side}, force={force}")
-        if side not in ["left", "right", "auto"]:
+        try:
+            return self._flash_keyboard(side, keyboard, explicit_side, force, features, clean)
+        finally:
+            # The HID connection is kept open for the whole flash
+            self.comm.disconnect()
+    
+    def _flash_keyboard(self, side: str, keyboard: Optional[str], explicit_side: bool, force: bool, features: Optional[Dict[str, Any]], clean: bool) -> bool:
+        """Implementation of flash_keyboard(), which closes the HID connection afterwards."""
+        logger.debug("FlashManager.flash_keyboard called with side=%r, explicit_side=%s, force=%s",
+                     side, explicit_side, force)
+        if side not in REQUESTED_SIDES:
             print(f"Error: Invalid side '{side}'. Must be 'left' or 'right'.")
             return False
         
         # Get keyboard features
-        try:
-            features = get_features(keyboard)
-        except Exception as e:
-            print(f"Error detecting keyboard features: {e}")
-            return False
+        if features is not None:
+            self._features_cache[keyboard] = features
+        else:
+            try:
+                features = self._features(keyboard)
+            except Exception as e:
+                print(f"Error detecting keyboard features: {e}")
+                return False
+        
+        # Clean previous build artifacts only when the build inputs changed,
+        # otherwise let make rebuild incrementally. When the side is already
+        # settled, decide now and start `qmk clean` in the background. A side
+        # that side lock may still reject must not touch the build, so that
+        # case is decided after the query, like side "auto".
+        keymap_dir = Path(features['keyboard_path']) / "keymaps" / self._get_current_keymap()
+        side_pending = features.get('side_lock_enabled', False) and not force
+        build_hash = needs_clean = clean_proc = None
+        if side in SIDES and not side_pending:
+            build_hash = self._build_hash(keymap_dir, features, side)
+            needs_clean = clean or self._last_build_hash(keymap_dir) != build_hash
+            if needs_clean:
+                print("Cleaning QMK build artifacts...")
+                self._forget_build_hash(keymap_dir)
+                clean_proc = subprocess.Popen(['qmk', 'clean'])
         
         # Handle side_lock logic
-        if features.get('side_lock_enabled', False):
-            print(f"DEBUG: Side lock enabled, requested='{side}', force={force}")
-            final_side = self._handle_side_lock(side, explicit_side, features, force)
-            if final_side is None:
-                return False
-            print(f"DEBUG: Side lock resolved '{side}' -> '{final_side}'")
-            side = final_side
+        try:
+            if features.get('side_lock_enabled', False):
+                logger.debug("Side lock enabled, requested=%r, force=%s", side, force)
+                final_side = self._handle_side_lock(side, explicit_side, features, force)
+                if final_side is None:
+                    return False
+                logger.debug("Side lock resolved %r -> %r", side, final_side)
+                side = final_side
+        finally:
+            # Never leave a clean running, even when aborting
+            clean_status = clean_proc.wait() if clean_proc is not None else None
+        
+        if clean_status:
+            raise subprocess.CalledProcessError(clean_status, clean_proc.args)
         
-        print(f"\nFlashing the *{side}* side of {features['keyboard']}")
-        self._print_side_indicator(side)
+        print(f"\nFlashing the *{side}* side of {features['keyboard']}\n\n{SIDE_INDICATORS.get(side, '')}\n")
         
         # Determine flash strategy based on features and platform
-        flash_command, post_command = self._build_flash_commands(features, side)
+        flash_command, flash_env, post_command, post_cwd = self._build_flash_commands(features, side)
         
         if not flash_command:
             print("Error: Could not determine flash command")
@@ -65,18 +228,29 @@ class FlashManager:
         # Determine if this is a compile-only command (when auto_bootloader is enabled)
         is_compile_only = features.get('auto_bootloader', False)
         
-                # Clean previous build artifacts to ensure fresh compilation
-        print("Cleaning QMK build artifacts...")
-        subprocess.run(['qmk', 'clean'], check=True)
-        print("✓ QMK build artifacts cleaned.")
+        # The side was only settled by side lock, so decide on cleaning now
+        if build_hash is None:
+            build_hash = self._build_hash(keymap_dir, features, side)
+            needs_clean = clean or self._last_build_hash(keymap_dir) != build_hash
+        if needs_clean:
+            if clean_proc is None:
+                print("Cleaning QMK build artifacts...")
+                self._forget_build_hash(keymap_dir)
+                subprocess.run(['qmk', 'clean'], check=True)
+            print("✓ QMK build artifacts cleaned.")
+        else:
+            print("✓ Build inputs unchanged, skipping qmk clean")
 
         # Execute flash command (compile, or compile+flash)
-        print(f"\nRunning: {flash_command}")
+        # An argv list without a shell lets subprocess use posix_spawn
+        # instead of forking this process
+        print(f"\nRunning: {_format_command(flash_command, flash_env)}")
         try:
-            result = subprocess.run(flash_command, shell=True, check=True)
+            subprocess.run(flash_command, env={**os.environ, **flash_env}, check=True)
         except subprocess.CalledProcessError as e:
             print(f"Flash command failed with exit code {e.returncode}")
             return False
+        self._record_build_hash(keymap_dir, build_hash)
         
         if is_compile_only:
             print("✓ Compilation successful")
@@ -91,10 +265,10 @@ class FlashManager:
             
             # Execute post-bootloader command (actual flashing)
             if post_command:
-                print(f"Running flash command: {post_command}")
+                print(f"Running flash command: {_format_command(post_command, cwd=post_cwd)}")
                 try:
-                    subprocess.run(post_command, shell=True, check=True)
-                except subprocess.CalledProcessError as e:
+                    subprocess.run(post_command, cwd=post_cwd, check=True)
+                except (subprocess.CalledProcessError, OSError) as e:
                     print(f"Flash command failed: {e}")
                     return False
         else:
@@ -102,10 +276,10 @@ class FlashManager:
             
             # Execute post-command if needed (cleanup, etc.)
             if post_command:
-                print(f"Running post-command: {post_command}")
+                print(f"Running post-command: {_format_command(post_command, cwd=post_cwd)}")
                 try:
-                    subprocess.run(post_command, shell=True, check=True)
-                except subprocess.CalledProcessError as e:
+                    subprocess.run(post_command, cwd=post_cwd, check=True)
+                except (subprocess.CalledProcessError, OSError) as e:
                     print(f"Post-command failed: {e}")
                     # Don't return False here as the main flash might have succeeded
         
@@ -137,9 +311,9 @@ class FlashManager:
         # Otherwise, we need to check the current side first
         
         # Query the keyboard for its current side via HID
-        comm = HIDCommunicator()
+        comm = self.comm
         
-        if not comm.connect():
+        if comm.device is None and not comm.connect():
             print("❌ Cannot connect to keyboard via HID")
             print("   Side lock requires HID connection to query keyboard side")
             print("   Either:")
@@ -149,7 +323,6 @@ class FlashManager:
         
         try:
             side_info = comm.get_side_info()
-            comm.disconnect()
             
             if not side_info:
                 print("❌ No side information available from keyboard")
@@ -163,7 +336,7 @@ class FlashManager:
                 print("   Use explicit side for initial flash: ./flash.sh left")
                 return None
             
-            if current_side not in ['left', 'right']:
+            if current_side not in SIDES:
                 print(f"❌ Keyboard reported invalid side: {current_side}")
                 return None
             
@@ -186,15 +359,6 @@ class FlashManager:
             print(f"❌ Error querying keyboard side: {e}")
             return None
     
-    def _print_side_indicator(self, side: str):
-        """Print visual indicator of which side is being flashed."""
-        print()
-        if side == "left":
-            print("<----------------------- The one over here")
-        elif side == "right":
-            print("The one over there ---------------------->")
-        print()
-    
     def _find_qmk_root(self) -> Optional[Path]:
         """
         Find QMK firmware root by traversing up the directory tree until we find util/uf2conv.py.
@@ -202,113 +366,143 @@ class FlashManager:
         Returns:
             Path to QMK firmware root or None if not found
         """
-        current_path = Path.cwd().resolve()
-        
-        # Traverse up the directory tree
-        while current_path != current_path.parent:
-            uf2conv_path = current_path / "util" / "uf2conv.py"
-            if uf2conv_path.exists():
-                return current_path
-            current_path = current_path.parent
-        
-        return None
+        return _find_qmk_root(str(Path.cwd().resolve()))
 
-    def _build_flash_commands(self, features: Dict[str, Any], side: str) -> Tuple[Optional[str], Optional[str]]:
+    def _build_flash_commands(self, features: Dict[str, Any], side: str) -> Tuple[Optional[List[str]], Dict[str, str], Optional[List[str]], Optional[Path]]:
         """
         Build flash and post-flash commands based on features and platform.
         
         Returns:
-            Tuple of (flash_command, post_command)
+            Tuple of (flash_command argv, extra environment for it,
+            post_command argv, directory to run post_command in)
         """
-        print(f"DEBUG: _build_flash_commands called with side='{side}'")
-        if not features['split_enabled']:
-            # Single keyboard
-            if features.get('auto_bootloader', False):
-                return "qmk compile", None
-            else:
-                return "qmk flash", None
-        
-        # Split keyboard logic
+        logger.debug("_build_flash_commands called with side=%r", side)
         bootloader = features['bootloader']
-        auto_bootloader = features.get('auto_bootloader', False)
+        key = (bootloader == 'rp2040', features.get('auto_bootloader', False), features['split_enabled'])
+        argv_template, env_template, post_template = _FLASH_COMMANDS[key]
         
-        if auto_bootloader:
-            # Use compile-first approach with auto bootloader triggering
-            side_flag = f"-DMASTER_{side.upper()} -DINIT_EE_HANDS_{side.upper()}"
-            # Pass EXTRAFLAGS through to qmk compile - ensure they're used in compilation
-            compile_cmd = f'EXTRAFLAGS="{side_flag}" qmk compile'
+        fields = {
+            'jobs': self._jobs,
+            'side': side,
+            'bootloader': bootloader,
+            'side_flag': _SIDE_FLAGS.get(side, ''),
+        }
+        post_cwd = None
+        if post_template is not None and '{filename}' in post_template:
+            # Find QMK firmware root dynamically
+            post_cwd = self._find_qmk_root()
+            if not post_cwd:
+                print("Error: Could not find QMK firmware root (util/uf2conv.py)")
+                return None, {}, None, None
             
-            if bootloader == 'rp2040':
-                # Get the compiled firmware file
-                keyboard_name = features['keyboard'].replace('/', '_')
-                keymap = self._get_current_keymap()
-                filename = f"{keyboard_name}_{keymap}.uf2"
-                
-                # Find QMK firmware root dynamically
-                qmk_root = self._find_qmk_root()
-                if not qmk_root:
-                    print("Error: Could not find QMK firmware root (util/uf2conv.py)")
-                    return None, None
-                
-                # Use QMK's built-in uf2conv.py tool with --wait --deploy for automatic reboot
-                post_cmd = f"cd {qmk_root} && ./util/uf2conv.py --wait --deploy {filename}"
-            else:
-                # For other bootloaders, use appropriate flash command after bootloader trigger
-                post_cmd = f"qmk flash -bl {bootloader}-split-{side}"
-            
-            return compile_cmd, post_cmd
-        else:
-            # Use traditional qmk flash approach
-            if bootloader == 'rp2040':
-                return f"qmk flash -bl uf2-split-{side}", None
-            else:
-                return f"qmk flash -bl {bootloader}-split-{side}", None
+            # The compiled firmware file
+            keyboard_name = features['keyboard'].replace('/', '_')
+            fields['filename'] = f"{keyboard_name}_{self._get_current_keymap()}.uf2"
+        
+        flash_command = [arg.format(**fields) for arg in argv_template]
+        flash_env = {name: value.format(**fields) for name, value in env_template.items()}
+        post_command = [arg.format(**fields) for arg in post_template] if post_template is not None else None
+        return flash_command, flash_env, post_command, post_cwd
     
-    def _get_current_keymap(self) -> str:
-        """Get current keymap from qmk config."""
+    def _build_hash(self, keymap_dir: Path, features: Dict[str, Any], side: str) -> str:
+        """Hash everything a build depends on that make does not track itself."""
+        hasher = hashlib.blake2b()
+        hasher.update(_hash_tree(keymap_dir).encode())
+        hasher.update(json.dumps(features, sort_keys=True, default=str).encode())
+        hasher.update(_SIDE_FLAGS.get(side, '').encode())
+        return hasher.hexdigest()
+    
+    def _last_build_hash(self, keymap_dir: Path) -> Optional[str]:
+        """Hash recorded for the last successful build of a keymap."""
+        hashes = load_json(cache_dir() / BUILD_HASHES_FILE)
+        return hashes.get(str(keymap_dir)) if isinstance(hashes, dict) else None
+    
+    def _record_build_hash(self, keymap_dir: Path, build_hash: str):
+        """Remember the inputs of a successful build."""
+        path = cache_dir() / BUILD_HASHES_FILE
+        hashes = load_json(path)
+        if not isinstance(hashes, dict):
+            hashes = {}
+        hashes[str(keymap_dir)] = build_hash
+        store_json(path, hashes)
+    
+    def _forget_build_hash(self, keymap_dir: Path):
+        """
+        Drop the recorded hash of a keymap before its artifacts are cleaned.
+        
+        Until the next build succeeds the build directory matches no recorded
+        inputs, so a failed or interrupted build must not let a later run
+        skip the clean and link objects compiled for the other side.
+        """
+        path = cache_dir() / BUILD_HASHES_FILE
+        hashes = load_json(path)
+        if isinstance(hashes, dict) and hashes.pop(str(keymap_dir), None) is not None:
+            store_json(path, hashes)
+    
+    def _qmk_config_cached(self, key: str) -> Optional[str]:
+        """
+        Look up a user.* setting (e.g. "keymap") from the QMK CLI configuration.
+        
+        All settings are loaded on first use, from qmk.ini when it can be read
+        directly and otherwise from a single `qmk config user` run, so later
+        lookups spawn no processes.
+        """
+        if self._qmk_cfg is None:
+            self._qmk_cfg = read_qmk_user_config() or self._run_qmk_config_user()
+        return self._qmk_cfg.get(key)
+    
+    def _run_qmk_config_user(self) -> Dict[str, str]:
+        """Get every user.* setting from one `qmk config user` invocation."""
         try:
-            result = subprocess.run(['qmk', 'config', 'user.keymap'], 
+            result = subprocess.run(['qmk', 'config', 'user'],
                                   capture_output=True, text=True, check=True)
-            return result.stdout.strip().split('=')[1]
-        except (subprocess.CalledProcessError, IndexError):
-            return "default"
+        except (subprocess.CalledProcessError, OSError):
+            return {}
+        
+        config = {}
+        for line in result.stdout.splitlines():
+            name, sep, value = line.strip().partition('=')
+            # Unset options are reported as "None"
+            if sep and name.startswith('user.') and value and value != 'None':
+                config[name[len('user.'):]] = value
+        return config
+    
+    def _get_current_keymap(self) -> str:
+        """Get current keymap from qmk config."""
+        return self._qmk_config_cached('keymap') or "default"
     
     def validate_flash_environment(self) -> bool:
         """Validate that the environment is ready for flashing."""
+        import shutil
+        
         # Check if qmk command is available
         if not shutil.which('qmk'):
             print("Error: qmk command not found. Please install QMK CLI.")
             return False
         
         # Check if current keyboard is set
-        try:
-            result = subprocess.run(['qmk', 'config', 'user.keyboard'], 
-                                  capture_output=True, text=True, check=True)
-            if not result.stdout.strip().split('=')[1]:
-                print("Error: No keyboard selected. Use 'qmk config user.keyboard=...'")
-                return False
-        except subprocess.CalledProcessError:
-            print("Error: Could not get keyboard configuration")
+        if not self._qmk_config_cached('keyboard'):
+            print("Error: No keyboard selected. Use 'qmk config user.keyboard=...'")
             return False
         
         # Platform-specific checks
         if self.system == "Darwin":
             # Check for picotool on macOS
-            features = get_features()
+            features = self._features()
             if features.get('bootloader') == 'rp2040' and not shutil.which('picotool'):
                 print("Warning: picotool not found. Install with 'brew install picotool'")
         
         return True
 
 
-def flash_keyboard(side: str = "right", keyboard: Optional[str] = None, explicit_side: bool = False, force: bool = False) -> bool:
+def flash_keyboard(side: str = "right", keyboard: Optional[str] = None, explicit_side: bool = False, force: bool = False, clean: bool = False) -> bool:
     """Convenience function to flash keyboard."""
     manager = FlashManager()
     
     if not manager.validate_flash_environment():
         return False
     
-    return manager.flash_keyboard(side, keyboard, explicit_side, force)
+    return manager.flash_keyboard(side, keyboard, explicit_side, force, clean=clean)
 
 
 if __name__ == "__main__":
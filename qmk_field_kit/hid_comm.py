@@ -1,16 +1,37 @@
 #!/usr/bin/env python3
 
+import re
 import time
-import platform
 from typing import Optional, List, Dict, Any
 
-# Try to import hid library, fall back gracefully if not available
-try:
-    import hid
-    HID_AVAILABLE = True
-except ImportError:
-    HID_AVAILABLE = False
-    print("Warning: hidapi library not available. Install with: pip install -r requirements.txt")
+# The hid module dlopens hidapi/libusb, so it is imported on first use rather
+# than when this module is loaded. None: not tried yet, False: not installed.
+_hid = None
+
+
+def _get_hid():
+    """Return the hid module, importing it on first use (None if unavailable)."""
+    global _hid
+    if _hid is None:
+        try:
+            import hid
+            _hid = hid
+        except ImportError:
+            _hid = False
+            print("Warning: hidapi library not available. Install with: pip install -r requirements.txt")
+    return _hid or None
+
+
+def hid_available() -> bool:
+    """Check whether the hid library can be used."""
+    return _get_hid() is not None
+
+
+def __getattr__(name):
+    # HID_AVAILABLE is kept for compatibility; reading it imports hid
+    if name == 'HID_AVAILABLE':
+        return hid_available()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class HIDCommunicator:
@@ -26,16 +47,36 @@ class HIDCommunicator:
     RESPONSE_ERROR = 0x00
     RESPONSE_BOOTLOADER_TRIGGERED = 0x02
     RESPONSE_INFO = 0x03
+    SUCCESS_RESPONSES = frozenset({RESPONSE_OK, RESPONSE_BOOTLOADER_TRIGGERED, RESPONSE_INFO})
+    
+    # Raw HID report size used by the firmware
+    REPORT_SIZE = 32
+    _ZERO_REPORT = memoryview(bytes(REPORT_SIZE))
+    
+    # KEY=VALUE fields of an info response, separated by |
+    _KV_RE = re.compile(r'([^|=]+)=([^|]*)')
+    
+    # Commands answered by ALL_INFO, in the order their reports arrive
+    ALL_INFO_RECORDS = ('FIRMWARE_INFO', 'SIDE_INFO', 'STATUS')
     
     def __init__(self, vid: int = 0xFEED, pid: int = 0x0000):
         self.vid = vid
         self.pid = pid
         self.device = None
+        import platform
         self.system = platform.system()
+        # Successful responses to ALL_INFO_RECORDS for the current connection
+        self._info_cache: Dict[str, Dict[str, Any]] = {}
+        self._all_info_supported = True
+        # Outgoing report, reused by every command: [ID1, ID2, command, ETX, padding]
+        self._tx = bytearray(self.REPORT_SIZE)
+        self._tx[0] = self.FIELD_KIT_ID1
+        self._tx[1] = self.FIELD_KIT_ID2
     
     def find_device(self) -> Optional[Dict[str, Any]]:
         """Find the keyboard HID device."""
-        if not HID_AVAILABLE:
+        hid = _get_hid()
+        if hid is None:
             return None
         
         devices = hid.enumerate(self.vid, self.pid)
@@ -58,7 +99,8 @@ class HIDCommunicator:
     
     def connect(self) -> bool:
         """Connect to the keyboard HID device."""
-        if not HID_AVAILABLE:
+        hid = _get_hid()
+        if hid is None:
             print("HID library not available")
             return False
         
@@ -82,70 +124,106 @@ class HIDCommunicator:
             return False
     
     def disconnect(self):
-        """Disconnect from the device."""
-        if self.device:
-            try:
-                self.device.__exit__(None, None, None)
-            except:
-                pass
-            self.device = None
+        """Disconnect from the device. Safe to call when not connected."""
+        self._info_cache = {}
+        device, self.device = self.device, None
+        if device is None:
+            return
+        
+        try:
+            device.close()
+        except (OSError, _get_hid().HIDException):
+            # The device may already be gone, e.g. after entering the bootloader
+            pass
     
     def send_command(self, command: str, timeout: float = 5.0) -> Optional[Dict[str, Any]]:
         """Send a command and wait for response."""
-        if not self.device:
-            if not self.connect():
-                return None
+        responses = self._transact(command, 1, timeout)
+        return responses[0] if responses else None
+    
+    def _transact(self, command: str, replies: int, timeout: float = 5.0) -> Optional[List[Dict[str, Any]]]:
+        """
+        Send a command and read up to replies response reports.
+        
+        Reading stops early at the first unsuccessful response, so a firmware
+        that rejects the command is not waited on for the remaining reports.
+        """
+        reused = self.device is not None
+        if not reused and not self.connect():
+            return None
         
         try:
-            # Prepare message: [ID1, ID2, command, ETX]
-            message = command.encode('utf-8') + bytes([self.ETX_TERMINATOR])
-            packet = bytes([self.FIELD_KIT_ID1, self.FIELD_KIT_ID2]) + message
-            
-            # Pad packet to match HID report size (typically 32 or 64 bytes)
-            report_size = 32  # Common size for raw HID reports
-            if len(packet) < report_size:
-                packet += b'\x00' * (report_size - len(packet))
-            elif len(packet) > report_size:
-                packet = packet[:report_size]
-            
-            # Send the packet (convert to bytes if needed)
-            if isinstance(packet, list):
-                packet = bytes(packet)
-            self.device.write(packet)
+            # Fill the report buffer in place: the command (truncated to fit
+            # the report), ETX, then zero padding over any previous command
+            report_size = self.REPORT_SIZE
+            encoded = command.encode('utf-8')[:report_size - 3]
+            end = 2 + len(encoded)
+            self._tx[2:end] = encoded
+            self._tx[end] = self.ETX_TERMINATOR
+            self._tx[end + 1:] = self._ZERO_REPORT[end + 1:]
+            try:
+                self.device.write(bytes(self._tx))
+            except (OSError, _get_hid().HIDException):
+                # A connection kept open across e.g. a long compile goes stale
+                # if the keyboard re-enumerated; reopen it and resend once
+                # rather than mistaking the failure for a reboot below
+                if not reused:
+                    raise
+                self.disconnect()
+                if not self.connect():
+                    return None
+                self.device.write(bytes(self._tx))
             
-            # Wait for response
-            start_time = time.time()
-            while time.time() - start_time < timeout:
-                response = self.device.read(report_size, timeout=100)
+            # Wait for responses; each read blocks until a report arrives or the
+            # remaining time runs out, so there is no polling interval
+            deadline = time.monotonic() + timeout
+            responses = []
+            while len(responses) < replies:
+                remaining_ms = int((deadline - time.monotonic()) * 1000)
+                if remaining_ms <= 0:
+                    responses.append({'status': self.RESPONSE_ERROR, 'message': 'Timeout', 'success': False})
+                    break
+                response = self.device.read(report_size, timeout=remaining_ms)
                 
                 if response and len(response) > 0:
                     # Parse response
                     status = response[0]
-                    message_bytes = bytes(response[1:]).rstrip(b'\x00')
+                    if isinstance(response, list):
+                        response = bytes(response)
+                    # The message ends at ETX; firmware without the terminator
+                    # zero-pads the report instead
+                    end = response.find(self.ETX_TERMINATOR, 1)
+                    if end > 0:
+                        message_bytes = memoryview(response)[1:end].tobytes()
+                    else:
+                        message_bytes = memoryview(response)[1:].tobytes().rstrip(b'\x00')
                     message = message_bytes.decode('utf-8', errors='ignore')
                     
-                    return {
+                    responses.append({
                         'status': status,
                         'message': message,
-                        'success': status in [self.RESPONSE_OK, self.RESPONSE_BOOTLOADER_TRIGGERED, self.RESPONSE_INFO]
-                    }
+                        'success': status in self.SUCCESS_RESPONSES
+                    })
+                    if status not in self.SUCCESS_RESPONSES:
+                        break
             
-            return {'status': self.RESPONSE_ERROR, 'message': 'Timeout', 'success': False}
+            return responses
             
         except Exception as e:
             # Special handling for bootloader command - disconnection is expected success
             if command == "BOOTLOADER":
                 error_msg = str(e).lower()
                 if any(word in error_msg for word in ['success', 'disconnect', 'device', 'hid']):
-                    return {'status': self.RESPONSE_BOOTLOADER_TRIGGERED, 'message': 'Device entering bootloader', 'success': True}
+                    return [{'status': self.RESPONSE_BOOTLOADER_TRIGGERED, 'message': 'Device entering bootloader', 'success': True}]
             
             print(f"Communication error: {e}")
-            return {'status': self.RESPONSE_ERROR, 'message': str(e), 'success': False}
+            return [{'status': self.RESPONSE_ERROR, 'message': str(e), 'success': False}]
     
     def trigger_bootloader(self) -> bool:
         """Trigger bootloader mode."""
         print("Sending bootloader command via HID...")
         
+        self._info_cache = {}
         response = self.send_command("BOOTLOADER")
         
         if response and response['success']:
@@ -155,44 +233,100 @@ class HIDCommunicator:
             print(f"Bootloader command failed: {response['message'] if response else 'No response'}")
             return False
     
+    def get_all_info(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Get the FIRMWARE_INFO, SIDE_INFO and STATUS responses in one round-trip.
+        
+        A single ALL_INFO command is answered with one report per record, in
+        ALL_INFO_RECORDS order. Each record is cached until disconnect, so
+        get_firmware_info(), get_side_info() and ping() share one transaction.
+        Firmware without ALL_INFO is queried one command at a time instead.
+        """
+        info = {}
+        for command in self.ALL_INFO_RECORDS:
+            info[command] = self._info_response(command)
+            if self.device is None:
+                # Could not connect; the remaining queries would fail the same way
+                break
+        return info
+    
+    def _info_response(self, command: str) -> Optional[Dict[str, Any]]:
+        """Get the response to one of ALL_INFO_RECORDS, cached until disconnect."""
+        if command in self._info_cache:
+            return self._info_cache[command]
+        
+        if self._all_info_supported:
+            if not self._query_all_info():
+                return None
+            if self._all_info_supported:
+                return self._info_cache.get(command)
+        
+        # Firmware without ALL_INFO: send only the command that was asked for
+        response = self.send_command(command)
+        if response and response['success']:
+            self._info_cache[command] = response
+        return response
+    
+    def _query_all_info(self) -> bool:
+        """
+        Send ALL_INFO and cache every successful record it returns.
+        
+        Returns False if the keyboard could not be reached. Firmware that
+        does not know ALL_INFO is remembered, so later lookups skip it.
+        """
+        responses = self._transact("ALL_INFO", len(self.ALL_INFO_RECORDS))
+        if responses is None:
+            return False
+        
+        if responses[0]['message'] == "Unknown command":
+            self._all_info_supported = False
+            return True
+        
+        for command, response in zip(self.ALL_INFO_RECORDS, responses):
+            if response['success']:
+                self._info_cache[command] = response
+        return True
+    
     def get_firmware_info(self) -> Optional[Dict[str, str]]:
         """Get firmware information."""
-        response = self.send_command("FIRMWARE_INFO")
+        response = self._info_response("FIRMWARE_INFO")
         
         if response and response['success']:
-            # Parse key=value pairs separated by |
-            info = {}
-            parts = response['message'].split('|')
-            for part in parts:
-                if '=' in part:
-                    key, value = part.split('=', 1)
-                    info[key] = value
-            return info
+            return dict(self._KV_RE.findall(response['message']))
         
         return None
     
     def get_side_info(self) -> Optional[Dict[str, str]]:
         """Get keyboard side information."""
-        response = self.send_command("SIDE_INFO")
+        response = self._info_response("SIDE_INFO")
         
         if response and response['success']:
-            # Parse key=value pairs separated by |
-            info = {}
-            parts = response['message'].split('|')
-            for part in parts:
-                if '=' in part:
-                    key, value = part.split('=', 1)
-                    info[key] = value
-            return info
+            return dict(self._KV_RE.findall(response['message']))
         
         return None
     
     def ping(self) -> bool:
         """Test communication with the device."""
-        response = self.send_command("STATUS")
+        response = self._info_response("STATUS")
         return response and response['success']
 
 
+_SHARED_COMM: Optional[HIDCommunicator] = None
+
+
+def get_shared_hid() -> HIDCommunicator:
+    """
+    Return the HIDCommunicator shared within this process.
+    
+    Its device stays open between commands, so the keyboard is enumerated
+    and opened once rather than once per query.
+    """
+    global _SHARED_COMM
+    if _SHARED_COMM is None:
+        _SHARED_COMM = HIDCommunicator()
+    return _SHARED_COMM
+
+
 def test_hid_communication():
     """Test HID communication with the keyboard."""
     comm = HIDCommunicator()